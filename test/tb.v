@@ -7,11 +7,14 @@
 module tb ();
 
   // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
+  // Only built in with `make COCOTB_WAVES=1`, dumping slows every cycle down.
+`ifdef COCOTB_WAVES
   initial begin
     $dumpfile("tb.vcd");
     $dumpvars(0, tb);
     #1;
   end
+`endif
 
   // Wire up the inputs and outputs:
   reg clk;
@@ -22,6 +25,13 @@ module tb ();
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // Free-running 1 ns clock (CLOCK_PERIOD_NS in test.py). Generating it
+  // here rather than from a cocotb Clock coroutine keeps every edge inside
+  // the simulator.
+  initial clk = 0;
+  always #0.5 clk = ~clk;
+
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
@@ -46,4 +56,28 @@ module tb ();
       .rst_n  (rst_n)     // not reset
   );
 
+  // Membrane and spike in one vector, sampled as a unit by tb_capture.
+  wire [8:0] tb_obs = {uio_out[7], uo_out};
+
+  // Spike output on its own, so test.py can wait on its rising edge.
+  wire spike = uio_out[7];
+
+  // Sample buffer read back by _collect() in test.py.
+  localparam CAPTURE_DEPTH = 512;
+  reg capture_req;
+  reg [$clog2(CAPTURE_DEPTH):0] capture_len;
+  initial begin
+    capture_req = 0;
+    capture_len = 0;
+  end
+
+  tb_capture #(
+      .DEPTH(CAPTURE_DEPTH)
+  ) capture (
+      .clk   (clk),
+      .req   (capture_req),
+      .len   (capture_len),
+      .obs_in(tb_obs)
+  );
+
 endmodule
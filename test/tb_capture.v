@@ -0,0 +1,56 @@
+`default_nettype none
+`timescale 1ns / 1ps
+
+/* Testbench-only sample buffer. Records the 9-bit observation
+   {spike, membrane} (tb_obs in tb.v) on every rising clock edge so the cocotb
+   test can read a whole run back in one access instead of waking up on every
+   cycle.
+
+   A capture is started by toggling `req` with the number of samples in `len`.
+   While `req != ack` one sample is stored per clock; `ack` follows `req` once
+   the last sample is written; driving `req` back to `ack` cancels a capture
+   in flight. Slot i lives at mem_buf[8*i +: 8] / spk_buf[i];
+   the buffers and ack are read through the hierarchy, not through ports.
+
+   Like any flop, a slot holds tb_obs as it was just before its edge, not the
+   value the DUT settles to after it. Sample k is therefore one cycle behind
+   a read after RisingEdge (+ ReadOnly) of the same edge.
+*/
+module tb_capture #(
+    parameter DEPTH = 512
+) (
+    input wire                     clk,
+    input wire                     req,
+    input wire [$clog2(DEPTH):0]   len,     // 1..DEPTH, so one bit wider than wr_ptr
+    input wire [8:0]               obs_in
+);
+
+  reg [8*DEPTH-1:0]       mem_buf;
+  reg [DEPTH-1:0]         spk_buf;
+  reg                     ack;
+  reg [$clog2(DEPTH)-1:0] wr_ptr;
+
+  initial begin
+    mem_buf = 0;
+    spk_buf = 0;
+    wr_ptr  = 0;
+    ack     = 0;
+  end
+
+  always @(posedge clk) begin
+    if (req != ack) begin
+      mem_buf[{wr_ptr, 3'b000} +: 8] <= obs_in[7:0];
+      spk_buf[wr_ptr]                <= obs_in[8];
+      if (wr_ptr + 1 >= len) begin
+        wr_ptr <= 0;
+        ack    <= req;
+      end else begin
+        wr_ptr <= wr_ptr + 1;
+      end
+    end else begin
+      // an abandoned capture must not shift where the next one starts
+      wr_ptr <= 0;
+    end
+  end
+
+endmodule
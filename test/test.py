@@ -1,217 +1,285 @@
 # SPDX-FileCopyrightText: © 2024 Tiny Tapeout
 # SPDX-License-Identifier: Apache-2.0
 
+import math
+import os
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
 import cocotb
-from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles, RisingEdge
+import numpy as np
+from cocotb.triggers import ClockCycles, Edge, First, NextTimeStep, ReadOnly, RisingEdge, with_timeout
+from cocotb.utils import get_sim_time
+
+# FAST=1 runs all checks as phases of a single test_all_invariants.
+FAST = os.environ.get("FAST") == "1"
+
+# Seed for the random-stimulus phase; override with RANDOM_SEED=<n> to replay
+# or explore a different sequence.
+RANDOM_SEED = int(os.environ.get("RANDOM_SEED", "0xC0C07B"), 0)
+
+# Must match the clock generated in tb.v.
+CLOCK_PERIOD_NS = 1
+
+# Must match CAPTURE_DEPTH in tb.v.
+CAPTURE_DEPTH = 512
 
 
 # ----------------------------
 # Helpers: signal access
 # ----------------------------
 
-def _has(dut, name: str) -> bool:
-    try:
-        getattr(dut, name)
-        return True
-    except Exception:
-        return False
+# Toplevel signals by name, filled in by the first _signals() call.
+_SIGNALS = {}
 
-def _get_sig(dut, *names):
-    """Return the first signal that exists on dut."""
+def _signals(dut) -> dict:
+    """Walk dut's children once and index them by name."""
+    if not _SIGNALS:
+        _SIGNALS.update((child._name, child) for child in dut)
+    return _SIGNALS
+
+def _get_sig(sigs: dict, *names):
+    """Return the first signal that exists in sigs."""
     for n in names:
-        if _has(dut, n):
-            return getattr(dut, n)
+        if n in sigs:
+            return sigs[n]
     raise AttributeError(f"Could not find any of signals: {names}")
 
 def _as_uint(val) -> int:
+    # Same as .value.integer on cocotb 1.9, and still works on 2.x where
+    # .integer is deprecated.
     return int(val.value)
 
-def _get_ui_in(dut):
+def _get_ui_in(sigs: dict):
     # Tiny Tapeout common name in tests: ui_in
-    return _get_sig(dut, "ui_in", "ui", "ui_in_i")
-
-def _get_uo_out(dut):
-    # Common Tiny Tapeout wrapper output
-    return _get_sig(dut, "uo_out", "uo", "uo_out_o")
-
-def _get_uio_out(dut):
-    return _get_sig(dut, "uio_out", "uio", "uio_out_o")
-
-def _get_uio_oe(dut):
-    # not always present in testbench
-    for n in ("uio_oe", "uio_oe_o"):
-        if _has(dut, n):
-            return getattr(dut, n)
-    return None
+    return _get_sig(sigs, "ui_in", "ui", "ui_in_i")
 
-def _get_reset(dut):
-    return _get_sig(dut, "rst_n", "reset_n", "rst")
+def _get_reset(sigs: dict):
+    return _get_sig(sigs, "rst_n", "reset_n", "rst")
 
-def _get_enable(dut):
+def _get_enable(sigs: dict):
     # some TT wrappers include 'ena'
     for n in ("ena", "enable", "en"):
-        if _has(dut, n):
-            return getattr(dut, n)
+        if n in sigs:
+            return sigs[n]
     return None
 
-def _membrane(dut) -> int:
-    return _as_uint(_get_uo_out(dut))
-
-def _spike_bit(dut) -> int:
-    uio = _get_uio_out(dut)
-    width = len(uio.value)
-    # Your info.yaml says uio[7] is spike.
-    # If uio_out is 8-bit, take bit 7. If it's 1-bit, take bit 0.
-    if width >= 8:
-        return (int(uio.value) >> 7) & 1
-    return int(uio.value) & 1
 
+@dataclass
+class Handles:
+    """Signal handles resolved once per test by _init()."""
+    clk: Any
+    ui: Any
+    rst: Any
+    ena: Optional[Any]
+    spike: Any
+    capture: Any
+    capture_req: Any
+    capture_len: Any
+    capture_toggle: int = 0
+
+def _first_spike(spk) -> Optional[int]:
+    """Index of the first 1 in spk, or None."""
+    idx = np.flatnonzero(spk)
+    return int(idx[0]) if idx.size else None
+
+
+async def _init(dut) -> Handles:
+    """Put DUT in a known state. The clock is free-running in tb.v."""
+    sigs = _signals(dut)
+    h = Handles(
+        clk=sigs["clk"],
+        ui=_get_ui_in(sigs),
+        rst=_get_reset(sigs),
+        ena=_get_enable(sigs),
+        spike=sigs["spike"],
+        capture=sigs["capture"],
+        capture_req=sigs["capture_req"],
+        capture_len=sigs["capture_len"],
+        # tb_capture keeps its state from the previous test in this simulation
+        capture_toggle=_as_uint(sigs["capture"].ack),
+    )
 
-# ----------------------------
-# Clock API compatibility
-# ----------------------------
+    # Everything written here is held through 5 cycles of reset, so these can
+    # be deposited immediately instead of waiting for a ReadWrite phase.
+    if h.ena is not None:
+        h.ena.setimmediatevalue(1)
+
+    h.ui.setimmediatevalue(0)
+    # Cancel any capture a failed earlier test left in flight.
+    h.capture_req.setimmediatevalue(h.capture_toggle)
+
+    h.rst.setimmediatevalue(0)
+    await _release_reset(h)
+    return h
+
+async def _reset(h: Handles):
+    """Soft reset with zero input, for reusing a running simulation."""
+    h.ui.value = 0
+    h.rst.value = 0
+    await _release_reset(h)
+
+async def _release_reset(h: Handles):
+    await ClockCycles(h.clk, 5)
+    h.rst.value = 1
+    await ClockCycles(h.clk, 2)
+
+def _set_current(h: Handles, value: int):
+    """Drive ui_in; it is picked up on the next rising edge."""
+    h.ui.value = value & 0xFF
+
+async def _wait(h: Handles, cycles: int):
+    await ClockCycles(h.clk, cycles)
+
+async def _drive_current(h: Handles, value: int, cycles: int):
+    _set_current(h, value)
+    await _wait(h, cycles)
+
+def _start_capture(h: Handles, n: int):
+    """Arm tb_capture for n samples, starting at the next rising edge."""
+    h.capture_toggle ^= 1
+    h.capture_len.value = n
+    h.capture_req.value = h.capture_toggle
+
+async def _read_capture(h: Handles, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Wait for the armed capture to finish and return its first n samples."""
+    cap = h.capture
+    # _collect_until_spike may get here on the edge that ends the capture.
+    if _as_uint(cap.ack) != h.capture_toggle:
+        # A lost handshake would otherwise hang on the free-running clock.
+        await with_timeout(Edge(cap.ack), CLOCK_PERIOD_NS * (n + 2), "ns")
+    # ack flips in the same update as the last sample; read once the
+    # timestep has fully settled.
+    await ReadOnly()
+
+    mem_bytes = _as_uint(cap.mem_buf).to_bytes(CAPTURE_DEPTH, "little")
+    spk_bytes = _as_uint(cap.spk_buf).to_bytes(CAPTURE_DEPTH // 8, "little")
+    mem = np.frombuffer(mem_bytes, dtype=np.uint8, count=n)
+    spk = np.unpackbits(np.frombuffer(spk_bytes, dtype=np.uint8), count=n, bitorder="little")
+
+    # Leave the read-only phase so the next capture / caller can drive.
+    # This lands before the next rising edge, so no sample is lost.
+    await NextTimeStep()
+    return mem, spk
 
-def _make_clock(dut, period_ns=1):
+async def _collect(h: Handles, cycles: int):
     """
-    cocotb Clock API differs across versions:
-      - newer: Clock(sig, period, unit="ns")
-      - older: Clock(sig, period, units="ns")
+    Collect (membrane, spike) for N cycles.
+
+    Sampling is done by the tb_capture buffer in tb.v; we only wake up once per
+    CAPTURE_DEPTH cycles to read the whole buffer back. Returns two uint8
+    arrays of length N. Sample k is the value going into the k-th rising edge
+    after the call, i.e. what a RisingEdge + ReadOnly read of the previous
+    edge would have seen.
     """
-    try:
-        return Clock(dut.clk, period_ns, unit="ns")
-    except TypeError:
-        return Clock(dut.clk, period_ns, units="ns")
-
-
-async def _init(dut, period_ns=1):
-    """Start clock and put DUT in a known state."""
-    clock = _make_clock(dut, period_ns)
-    cocotb.start_soon(clock.start())
-
-    rst = _get_reset(dut)
-    ena = _get_enable(dut)
-    if ena is not None:
-        ena.value = 1
-
-    ui = _get_ui_in(dut)
-    ui.value = 0
-
-    # Reset
-    rst.value = 0
-    await ClockCycles(dut.clk, 5)
-    rst.value = 1
-    await ClockCycles(dut.clk, 2)
-
-async def _drive_current(dut, value: int, cycles: int):
-    ui = _get_ui_in(dut)
-    ui.value = value & 0xFF
-    await ClockCycles(dut.clk, cycles)
-
-async def _collect(dut, cycles: int):
-    """Collect (membrane, spike) for N cycles."""
-    mem = []
-    spk = []
-    for _ in range(cycles):
-        await RisingEdge(dut.clk)
-        mem.append(_membrane(dut))
-        spk.append(_spike_bit(dut))
+    mem = np.empty(cycles, dtype=np.uint8)
+    spk = np.empty(cycles, dtype=np.uint8)
+    pos = 0
+    while pos < cycles:
+        n = min(cycles - pos, CAPTURE_DEPTH)
+        _start_capture(h, n)
+        mem[pos:pos + n], spk[pos:pos + n] = await _read_capture(h, n)
+        pos += n
     return mem, spk
 
+async def _collect_until_spike(h: Handles, cycles: int, post: int = 1):
+    """
+    Like _collect, but stop `post` samples into the first spike instead of
+    always running N cycles, so the result may be shorter than N.
+
+    Python only wakes up for the spike itself and for the end of the capture.
+    """
+    assert cycles <= CAPTURE_DEPTH, f"Can't capture {cycles} cycles in one go"
+    t_start = get_sim_time("ns")
+    _start_capture(h, cycles)
+
+    spike = RisingEdge(h.spike)
+    first = First(spike, Edge(h.capture.ack))
+    if await with_timeout(first, CLOCK_PERIOD_NS * (cycles + 2), "ns") is spike:
+        # spike rises on the edge that loads the new membrane, so the first
+        # sample showing it is taken on the following edge. Round up because
+        # the capture may have been armed mid-cycle.
+        i = math.ceil((get_sim_time("ns") - t_start) / CLOCK_PERIOD_NS - 1e-6)
+        cycles = min(cycles, i + post)
+        h.capture_len.value = cycles
+
+    return await _read_capture(h, cycles)
+
 
 # ----------------------------
-# Core tests
+# Test phases
 # ----------------------------
 
-@cocotb.test()
-async def test_reset_clears_state(dut):
+async def _reset_clears_state(h: Handles):
     """
     After reset, outputs should settle to a deterministic baseline quickly.
     We don't assume baseline is exactly 0, but it should be stable with zero input.
     """
-    await _init(dut)
+    await _drive_current(h, 0, 5)
+    mem, spk = await _collect(h, 20)
 
-    await _drive_current(dut, 0, 5)
-    mem, spk = await _collect(dut, 20)
+    assert spk.sum() == 0, "Spike asserted with zero input right after reset"
 
-    assert sum(spk) == 0, "Spike asserted with zero input right after reset"
+    tail = mem[len(mem)//2 :].astype(int)
+    assert tail.max() - tail.min() <= 2, f"Membrane not stable after reset under 0 input: {tail}"
 
-    tail = mem[len(mem)//2 :]
-    assert max(tail) - min(tail) <= 2, f"Membrane not stable after reset under 0 input: {tail}"
 
-
-@cocotb.test()
-async def test_no_input_no_spike(dut):
+async def _no_input_no_spike(h: Handles):
     """With ui_in = 0 for an extended time, neuron should not spike."""
-    await _init(dut)
-
-    await _drive_current(dut, 0, 10)
-    _, spk = await _collect(dut, 200)
-    assert sum(spk) == 0, "Unexpected spike(s) with zero input"
+    await _drive_current(h, 0, 10)
+    _, spk = await _collect(h, 200)
+    assert spk.sum() == 0, "Unexpected spike(s) with zero input"
 
 
-@cocotb.test()
-async def test_integrates_up_with_constant_input(dut):
+async def _integrates_up_with_constant_input(h: Handles):
     """
     With a moderate constant input, membrane should tend to increase (at least initially)
     unless leak dominates heavily. We check for a positive trend early on.
     """
-    await _init(dut)
-
-    await _drive_current(dut, 20, 5)
-    mem, spk = await _collect(dut, 60)
+    await _drive_current(h, 20, 5)
+    mem, spk = await _collect_until_spike(h, 60)
 
-    if 1 in spk:
-        mem = mem[:spk.index(1)]
+    i = _first_spike(spk)
+    if i is not None:
+        mem = mem[:i]
 
     if len(mem) >= 10:
-        start_avg = sum(mem[:5]) / 5
-        mid_avg   = sum(mem[5:10]) / 5
+        start_avg = mem[:5].mean()
+        mid_avg   = mem[5:10].mean()
         assert mid_avg >= start_avg, f"Membrane didn't integrate upward early: start={start_avg}, mid={mid_avg}"
 
 
-@cocotb.test()
-async def test_leak_down_when_input_removed(dut):
+async def _leak_down_when_input_removed(h: Handles):
     """Drive neuron up with current, then set input to 0 and verify it leaks down."""
-    await _init(dut)
-
-    await _drive_current(dut, 30, 5)
-    mem1, _ = await _collect(dut, 50)
+    await _drive_current(h, 30, 5)
+    mem1, _ = await _collect(h, 50)
 
-    await _drive_current(dut, 0, 1)
-    mem2, spk2 = await _collect(dut, 80)
+    _set_current(h, 0)
+    mem2, spk2 = await _collect(h, 80)
 
-    charged_level = max(mem1) if mem1 else _membrane(dut)
-    after_level = sum(mem2[-10:]) / 10
+    charged_level = mem1.max()
+    after_level = mem2[-10:].mean()
 
     assert after_level <= charged_level + 2, f"Membrane didn't leak down after removing input: charged_peak={charged_level}, after_avg={after_level}"
-    assert sum(spk2) == 0, "Unexpected spike(s) after input removed (ui_in=0)"
+    assert spk2.sum() == 0, "Unexpected spike(s) after input removed (ui_in=0)"
 
 
-@cocotb.test()
-async def test_spike_and_reset_behavior(dut):
+async def _spike_and_reset_behavior(h: Handles):
     """
     Force at least one spike, then verify spike corresponds to a drop compared to recent pre-spike peak.
     Handles designs where reset happens in same cycle as spike.
     """
-    await _init(dut)
-
-    await _drive_current(dut, 255, 2)
-    mem, spk = await _collect(dut, 250)
-
-    assert 1 in spk, "Did not observe any spike under maximum input"
+    await _drive_current(h, 255, 2)
+    mem, spk = await _collect_until_spike(h, 250, post=5)
 
-    i = spk.index(1)
+    i = _first_spike(spk)
+    assert i is not None, "Did not observe any spike under maximum input"
 
-    pre_lo = max(0, i - 10)
-    pre_hi = i
-    pre_window = mem[pre_lo:pre_hi] if pre_hi > pre_lo else [mem[i]]
-    pre_peak = max(pre_window)
+    pre_window = mem[max(0, i - 10):i] if i > 0 else mem[i:i + 1]
+    pre_peak = pre_window.max()
 
-    post_lo = i
-    post_hi = min(len(mem), i + 5)
-    post_window = mem[post_lo:post_hi]
-    post_min = min(post_window)
+    post_window = mem[i:i + 5]
+    post_min = post_window.min()
 
     assert post_min <= pre_peak, (
         f"Spike did not cause a drop vs recent peak: "
@@ -220,78 +288,151 @@ async def test_spike_and_reset_behavior(dut):
     )
 
 
-@cocotb.test()
-async def test_spike_is_pulse_not_stuck_high(dut):
+async def _spike_is_pulse_not_stuck_high(h: Handles):
     """Spike should not remain high for many consecutive cycles."""
-    await _init(dut)
-
-    await _drive_current(dut, 255, 2)
-    _, spk = await _collect(dut, 200)
+    await _drive_current(h, 255, 2)
+    _, spk = await _collect(h, 200)
 
-    max_run = 0
-    run = 0
-    for b in spk:
-        if b == 1:
-            run += 1
-            max_run = max(max_run, run)
-        else:
-            run = 0
+    # Runs of 1s start where the padded diff is +1 and end where it is -1.
+    edges = np.diff(np.concatenate(([0], spk, [0])))
+    runs = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    max_run = runs.max(initial=0)
 
     assert max_run <= 2, f"Spike stayed high too long (max consecutive={max_run})"
 
 
-@cocotb.test()
-async def test_periodic_spiking_under_strong_drive(dut):
+async def _periodic_spiking_under_strong_drive(h: Handles):
     """Under strong constant input, expect multiple spikes."""
-    await _init(dut)
-
-    await _drive_current(dut, 200, 1)
-    _, spk = await _collect(dut, 400)
+    _set_current(h, 200)
+    _, spk = await _collect(h, 400)
 
-    assert sum(spk) >= 2, f"Expected repeated spikes under strong drive, saw {sum(spk)}"
+    assert spk.sum() >= 2, f"Expected repeated spikes under strong drive, saw {spk.sum()}"
 
 
-@cocotb.test()
-async def test_random_stimulus_invariants(dut):
+async def _random_stimulus_invariants(h: Handles):
     """Randomly vary input and check invariants."""
-    import random
+    cocotb.log.info(f"Random stimulus seed: {RANDOM_SEED:#x}")
+    stim = np.random.default_rng(RANDOM_SEED).integers(0, 256, 300, dtype=np.uint8).tolist()
+
+    async def drive():
+        for v in stim:
+            h.ui.value = v
+            await RisingEdge(h.clk)
+
+    # Drive one value per cycle while tb_capture records the response, then
+    # check the whole run at once.
+    driver = cocotb.start_soon(drive())
+    mem, spk = await _collect(h, len(stim))
+    await driver
+
+    # 8-bit membrane and 0/1 spike are guaranteed by how the capture is
+    # unpacked. What can break is the spike/membrane relationship: spike is a
+    # threshold on the membrane, so every spiking sample must sit above every
+    # quiet one, whatever the threshold is.
+    assert spk.any() and not spk.all(), f"Random drive gave no spike/no-spike mix (seed {RANDOM_SEED:#x})"
+    lowest_spiking = mem[spk == 1].min()
+    highest_quiet = mem[spk == 0].max()
+    assert lowest_spiking > highest_quiet, (
+        f"Spike not a threshold on the membrane: spiked at {lowest_spiking} "
+        f"but not at {highest_quiet} (seed {RANDOM_SEED:#x})"
+    )
+
+
+async def _step_response_charge_then_decay(h: Handles):
+    """Step input up then down; membrane should rise then decay."""
+    await _drive_current(h, 0, 5)
+    base, _ = await _collect(h, 20)
+    base_avg = base[-10:].mean()
+
+    _set_current(h, 40)
+    up, spk_up = await _collect_until_spike(h, 40)
+    i = _first_spike(spk_up)
+    if i is not None:
+        up = up[:i]
+    up_avg = up[-10:].mean() if len(up) >= 10 else None
+    if up_avg is not None:
+        assert up_avg >= base_avg, f"Membrane didn't increase on step up: base={base_avg}, up={up_avg}"
 
-    await _init(dut)
+    _set_current(h, 0)
+    down, spk_down = await _collect(h, 60)
+    down_avg = down[-10:].mean()
 
-    ui = _get_ui_in(dut)
+    assert spk_down.sum() == 0, "Unexpected spike(s) during decay with zero input"
+    assert down_avg <= (up_avg if up_avg is not None else (up.max() if len(up) else base_avg)) + 2, \
+        f"Membrane didn't decay after step down: down_avg={down_avg}"
 
-    for _ in range(300):
-        ui.value = random.randrange(0, 256)
-        await RisingEdge(dut.clk)
 
-        m = _membrane(dut)
-        s = _spike_bit(dut)
+# ----------------------------
+# Core tests
+# ----------------------------
 
-        assert 0 <= m <= 255, f"Membrane out of 8-bit range: {m}"
-        assert s in (0, 1), f"Spike not 0/1: {s}"
+@cocotb.test(skip=FAST)
+async def test_reset_clears_state(dut):
+    await _reset_clears_state(await _init(dut))
+
+
+@cocotb.test(skip=FAST)
+async def test_no_input_no_spike(dut):
+    await _no_input_no_spike(await _init(dut))
+
+
+@cocotb.test(skip=FAST)
+async def test_integrates_up_with_constant_input(dut):
+    await _integrates_up_with_constant_input(await _init(dut))
+
+
+@cocotb.test(skip=FAST)
+async def test_leak_down_when_input_removed(dut):
+    await _leak_down_when_input_removed(await _init(dut))
 
 
-@cocotb.test()
+@cocotb.test(skip=FAST)
+async def test_spike_and_reset_behavior(dut):
+    await _spike_and_reset_behavior(await _init(dut))
+
+
+@cocotb.test(skip=FAST)
+async def test_spike_is_pulse_not_stuck_high(dut):
+    await _spike_is_pulse_not_stuck_high(await _init(dut))
+
+
+@cocotb.test(skip=FAST)
+async def test_periodic_spiking_under_strong_drive(dut):
+    await _periodic_spiking_under_strong_drive(await _init(dut))
+
+
+@cocotb.test(skip=FAST)
+async def test_random_stimulus_invariants(dut):
+    await _random_stimulus_invariants(await _init(dut))
+
+
+@cocotb.test(skip=FAST)
 async def test_step_response_charge_then_decay(dut):
-    """Step input up then down; membrane should rise then decay."""
-    await _init(dut)
-
-    await _drive_current(dut, 0, 5)
-    base, _ = await _collect(dut, 20)
-    base_avg = sum(base[-10:]) / 10
-
-    await _drive_current(dut, 40, 1)
-    up, spk_up = await _collect(dut, 40)
-    if 1 in spk_up:
-        up = up[:spk_up.index(1)]
-    if len(up) >= 10:
-        up_avg = sum(up[-10:]) / 10
-        assert up_avg >= base_avg, f"Membrane didn't increase on step up: base={base_avg}, up={up_avg}"
+    await _step_response_charge_then_decay(await _init(dut))
 
-    await _drive_current(dut, 0, 1)
-    down, spk_down = await _collect(dut, 60)
-    down_avg = sum(down[-10:]) / 10
 
-    assert sum(spk_down) == 0, "Unexpected spike(s) during decay with zero input"
-    assert down_avg <= (sum(up[-10:]) / 10 if len(up) >= 10 else max(up, default=base_avg)) + 2, \
-        f"Membrane didn't decay after step down: down_avg={down_avg}"
\ No newline at end of file
+PHASES = (
+    _reset_clears_state,
+    _no_input_no_spike,
+    _integrates_up_with_constant_input,
+    _leak_down_when_input_removed,
+    _spike_and_reset_behavior,
+    _spike_is_pulse_not_stuck_high,
+    _periodic_spiking_under_strong_drive,
+    _random_stimulus_invariants,
+    _step_response_charge_then_decay,
+)
+
+
+@cocotb.test(skip=not FAST)
+async def test_all_invariants(dut):
+    """
+    Run every phase above back-to-back in one simulation, with a soft reset
+    between them instead of a fresh _init. Enabled with FAST=1.
+    """
+    h = await _init(dut)
+    for i, phase in enumerate(PHASES):
+        if i:
+            await _reset(h)
+        dut._log.info(f"Phase {phase.__name__}")
+        await phase(h)